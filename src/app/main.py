@@ -1,25 +1,48 @@
 """FastAPI entrypoint for the fashion search application."""
 
-from base64 import b64encode
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
-from io import BytesIO
-from typing import Any, AsyncGenerator, Optional
+import os
+import secrets
+from types import MappingProxyType
+from typing import Any, AsyncGenerator, BinaryIO, Optional
 
+import numpy as np
 from PIL import Image
-from fastapi import FastAPI, File, Form, Request, UploadFile
+from fastapi import (
+    FastAPI,
+    File,
+    Form,
+    HTTPException,
+    Request,
+    Response,
+    UploadFile,
+)
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import HTMLResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from jinja2 import Template
+from turbojpeg import TJPF_RGB, TurboJPEG
 
 from src.config import STATIC_DIR, TEMPLATE_DIR
-from src.search.engine import Engine
+from src.search.engine import SEARCH_WORKERS, Engine
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
-    """Create and store the shared search engine instance."""
+    """Create the shared search engine and precompile the page templates."""
     app.state.engine = Engine()
+    app.state.index_template = templates.get_template("index.html")
+    app.state.results_template = templates.get_template("partials/results.html")
+    app.state.empty_query_bodies = {
+        hx_request: app.state.results_template.render(
+            {**_EMPTY_CONTEXT, "hx_request": hx_request, "error": _EMPTY_QUERY_ERROR}
+        )
+        for hx_request in (True, False)
+    }
     yield
 
 
@@ -27,6 +50,34 @@ app = FastAPI(name="FashionSearch", lifespan=lifespan)
 templates = Jinja2Templates(directory=str(TEMPLATE_DIR))
 app.mount("/static", StaticFiles(directory=str(STATIC_DIR)), name="static")
 
+_TJ = TurboJPEG()
+_JPEG_MAGIC = b"\xff\xd8\xff"
+_PNG_MAGIC = b"\x89PNG\r\n\x1a\n"
+_DECODE_POOL = ThreadPoolExecutor(max_workers=os.cpu_count())
+_SEARCH_POOL = ThreadPoolExecutor(max_workers=SEARCH_WORKERS)
+_MAX_UPLOAD_BYTES = 25 * 1024 * 1024
+_MAX_FORM_OVERHEAD = 64 * 1024
+_SNIFF_BYTES = 12
+_PREVIEW_SIZE = (512, 512)
+_UPLOAD_TOO_LARGE_ERROR = "Image is too large, upload a file under 25 MB."
+# LRU of JPEG thumbnails of uploaded query images for the results preview. It
+# lives in process memory, so with several workers a preview is only served by
+# the worker that handled the search; a miss just 404s and no preview is shown.
+_QUERY_IMG_CACHE: OrderedDict[str, bytes] = OrderedDict()
+_QUERY_IMG_CACHE_SIZE = 256
+
+_HEALTH_BODY = b'{"status":"ok"}'
+_EMPTY_QUERY_ERROR = "Enter a description or upload an image to search."
+
+_EMPTY_CONTEXT = MappingProxyType(
+    {
+        "items": (),
+        "query": MappingProxyType({"Query Text": None, "Query Image": None}),
+        "filters": None,
+        "error": None,
+    }
+)
+
 
 @app.middleware("http")
 async def disable_client_cache(request: Request, call_next):
@@ -38,6 +89,20 @@ async def disable_client_cache(request: Request, call_next):
     return response
 
 
+@app.middleware("http")
+async def reject_oversized_upload(request: Request, call_next):
+    """Refuse search bodies over the upload cap before the form is parsed."""
+    length = request.headers.get("content-length")
+    if (
+        request.url.path == "/search"
+        and length is not None
+        and length.isdigit()
+        and int(length) > _MAX_UPLOAD_BYTES + _MAX_FORM_OVERHEAD
+    ):
+        return _too_large(request)
+    return await call_next(request)
+
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -47,35 +112,104 @@ app.add_middleware(
 )
 
 
-@app.get("/health")
-def health() -> dict[str, str]:
+@app.get("/health", include_in_schema=False)
+def health() -> Response:
     """Return the health of the application."""
-    return {"status": "ok"}
+    return Response(content=_HEALTH_BODY, media_type="application/json")
 
 
-def _empty_context() -> dict[str, Any]:
-    """Return the default template context."""
-    return {
-        "items": [],
-        "query": {"Query Text": None, "Query Image": None},
-        "filters": None,
-        "error": None,
-    }
+def _render(
+    template: Template,
+    context: dict[str, Any],
+    status_code: int = 200,
+) -> HTMLResponse:
+    """Render a precompiled template into an HTML response."""
+    return HTMLResponse(template.render(context), status_code=status_code)
+
+
+def _too_large(request: Request) -> HTMLResponse:
+    """Render the upload size error."""
+    context = {"request": request, **_EMPTY_CONTEXT, "error": _UPLOAD_TOO_LARGE_ERROR}
+    return _render(app.state.results_template, context, status_code=413)
 
 
-def _encode_query_image(image: Image.Image) -> str:
-    """Convert a PIL image into a data URL."""
-    buffer = BytesIO()
-    image.save(buffer, format="JPEG")
-    encoded = b64encode(buffer.getvalue()).decode("utf-8")
-    return f"data:image/jpeg;base64,{encoded}"
+def _upload_size(upload: UploadFile) -> int:
+    """Return the upload size in bytes without reading it into memory."""
+    if upload.size is not None:
+        return upload.size
+    upload.file.seek(0, os.SEEK_END)
+    size = upload.file.tell()
+    upload.file.seek(0)
+    return size
+
+
+def _sniff_media_type(content: bytes) -> Optional[str]:
+    """Return the image media type from the magic bytes, or None if unsupported."""
+    if content[:3] == _JPEG_MAGIC:
+        return "image/jpeg"
+    if content[:8] == _PNG_MAGIC:
+        return "image/png"
+    if content[:4] == b"RIFF" and content[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+def _decode_upload(file: BinaryIO, media_type: str) -> tuple[np.ndarray, bytes]:
+    """Decode an upload into an HxWx3 uint8 RGB array and a JPEG preview."""
+    image: Optional[np.ndarray] = None
+    if media_type == "image/jpeg":
+        # TurboJPEG needs the whole buffer; Pillow streams from the spooled file.
+        buf = file.read()
+        try:
+            width, height, _, _ = _TJ.decode_header(buf)
+        except Exception:
+            width = height = 0
+        if Image.MAX_IMAGE_PIXELS and width * height > Image.MAX_IMAGE_PIXELS:
+            msg = f"{width}x{height} pixels exceeds the decompression bomb limit"
+            raise Image.DecompressionBombError(msg)
+        try:
+            image = _TJ.decode(buf, pixel_format=TJPF_RGB)
+        except Exception:
+            # CMYK and some progressive JPEGs are left to Pillow, which also
+            # applies its own pixel limit to anything the header check missed.
+            file.seek(0)
+    if image is None:
+        preview = Image.open(file).convert("RGB")
+        image = np.asarray(preview, dtype=np.uint8)
+    else:
+        preview = Image.fromarray(image)
+    preview.thumbnail(_PREVIEW_SIZE)
+    return image, _TJ.encode(np.asarray(preview), pixel_format=TJPF_RGB)
+
+
+def _cache_query_image(preview: bytes) -> str:
+    """Store a preview thumbnail and return the URL it is served from."""
+    token = secrets.token_urlsafe(8)
+    _QUERY_IMG_CACHE[token] = preview
+    while len(_QUERY_IMG_CACHE) > _QUERY_IMG_CACHE_SIZE:
+        _QUERY_IMG_CACHE.popitem(last=False)
+    return f"/query-image/{token}"
 
 
 @app.get("/", response_class=HTMLResponse)
 async def index(request: Request) -> HTMLResponse:
     """Render the search landing page."""
-    context = {"request": request, **_empty_context()}
-    return templates.TemplateResponse("index.html", context)
+    context = {"request": request, **_EMPTY_CONTEXT}
+    return _render(app.state.index_template, context)
+
+
+@app.get("/query-image/{token}")
+async def query_image(token: str) -> Response:
+    """Serve a previously uploaded query image for the results preview."""
+    cached = _QUERY_IMG_CACHE.get(token)
+    if cached is None:
+        raise HTTPException(status_code=404)
+    _QUERY_IMG_CACHE.move_to_end(token)
+    return Response(
+        content=cached,
+        media_type="image/jpeg",
+        headers={"X-Content-Type-Options": "nosniff"},
+    )
 
 
 @app.post("/search", response_class=HTMLResponse)
@@ -86,44 +220,49 @@ async def search(
 ) -> HTMLResponse:
     """Process a search submission using text and/or image input."""
     engine: Engine = app.state.engine
-    image_data_url: Optional[str] = None
+    query_image_url: Optional[str] = None
 
     if not q_text and (not q_image or not q_image.filename):
-        context = {
-            "request": request,
-            **_empty_context(),
-            "error": "Enter a description or upload an image to search.",
-        }
-        return templates.TemplateResponse(
-            "partials/results.html",
-            context,
-        )
+        hx_request = bool(request.headers.get("hx-request"))
+        return HTMLResponse(app.state.empty_query_bodies[hx_request], status_code=400)
 
-    image: Optional[Image.Image] = None
+    loop = asyncio.get_running_loop()
+    image: Optional[np.ndarray] = None
     if q_image and q_image.filename:
-        content = await q_image.read()
+        if _upload_size(q_image) > _MAX_UPLOAD_BYTES:
+            return _too_large(request)
+        media_type = _sniff_media_type(await q_image.read(_SNIFF_BYTES))
+        await q_image.seek(0)
+        if media_type is None:
+            context = {
+                "request": request,
+                **_EMPTY_CONTEXT,
+                "error": "Invalid image: upload a JPEG, PNG or WebP file.",
+            }
+            return _render(app.state.results_template, context, status_code=415)
         try:
-            image = Image.open(BytesIO(content)).convert("RGB")
+            image, preview = await loop.run_in_executor(
+                _DECODE_POOL, _decode_upload, q_image.file, media_type
+            )
         except Exception as e:
             context = {
                 "request": request,
-                **_empty_context(),
+                **_EMPTY_CONTEXT,
                 "error": f"Invalid image: {e}",
             }
-            return templates.TemplateResponse(
-                "partials/results.html",
-                context,
-            )
-        image_data_url = _encode_query_image(image)
+            return _render(app.state.results_template, context, status_code=400)
+        query_image_url = _cache_query_image(preview)
 
-    output = engine.run(q_text=q_text, q_image=image)
+    # Engine.run blocks on the encoders and psycopg2; keep it off the event loop
+    # so concurrent requests overlap and can share encoder batches.
+    output = await loop.run_in_executor(_SEARCH_POOL, engine.run, q_text, image)
     query_payload = dict(output.get("Query") or {})
     if "Query Text" not in query_payload:
         query_payload["Query Text"] = q_text
     if "Query Image" not in query_payload:
         query_payload["Query Image"] = None
-    if image_data_url:
-        query_payload["Query Image"] = image_data_url
+    if query_image_url:
+        query_payload["Query Image"] = query_image_url
 
     context = {
         "request": request,
@@ -132,7 +271,4 @@ async def search(
         "filters": output.get("Applied Filters"),
         "error": None,
     }
-    return templates.TemplateResponse(
-        "partials/results.html",
-        context,
-    )
+    return _render(app.state.results_template, context)
@@ -15,6 +15,7 @@ FRONTEND_DIR = PROJECT_ROOT / "frontend"
 SCRIPTS_DIR = PROJECT_ROOT / "scripts"
 DOCKER_DIR = PROJECT_ROOT / "docker"
 DATA_DIR = PROJECT_ROOT / "data"
+CACHE_DIR = Path.home() / ".cache" / "fashion-search"
 
 ATTRIBUTE_DIR = DATA_DIR / "attributes"
 IMAGE_DIR = DATA_DIR / "images"
@@ -22,18 +23,22 @@ IMAGE_DIR = DATA_DIR / "images"
 TEMPLATE_DIR = FRONTEND_DIR / "templates"
 STATIC_DIR = FRONTEND_DIR / "static"
 
-for dir_ in [
-    SRC_DIR,
-    FRONTEND_DIR,
-    SCRIPTS_DIR,
-    DOCKER_DIR,
-    DATA_DIR,
-    ATTRIBUTE_DIR,
-    IMAGE_DIR,
-    TEMPLATE_DIR,
-    STATIC_DIR,
-]:
-    dir_.mkdir(parents=True, exist_ok=True)
+
+def ensure_dirs() -> None:
+    """Create the project directories; called by CLI commands that write data."""
+    for dir_ in [
+        SRC_DIR,
+        FRONTEND_DIR,
+        SCRIPTS_DIR,
+        DOCKER_DIR,
+        DATA_DIR,
+        ATTRIBUTE_DIR,
+        IMAGE_DIR,
+        TEMPLATE_DIR,
+        STATIC_DIR,
+    ]:
+        dir_.mkdir(parents=True, exist_ok=True)
+
 
 ENVIRONMENT = os.getenv("ENVIRONMENT", "local")
 
@@ -46,8 +51,8 @@ if ENVIRONMENT == "lambda":
     POSTGRES_HOST = "localhost"
     POSTGRES_PORT = "15432"
 POSTGRES_DB_URL = f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
-
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+POSTGRES_READER_HOST = os.getenv("POSTGRES_READER_HOST") or POSTGRES_HOST
+POSTGRES_READER_DB_URL = f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_READER_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
 
 LAMBDA_SSH_KEY = os.getenv("LAMBDA_SSH_KEY")
 LAMBDA_DIR = os.getenv("LAMBDA_DIR")
@@ -60,3 +65,5 @@ OPENAI_MODEL = os.getenv("OPENAI_MODEL")
 CLIP_MODEL_NAME = os.getenv("CLIP_MODEL_NAME")
 CLIP_PRETRAINED = os.getenv("CLIP_PRETRAINED")
 ST_MODEL_NAME = os.getenv("ST_MODEL_NAME")
+ST_BACKEND = os.getenv("ST_BACKEND", "torch")
+ST_ONNX_FILE = os.getenv("ST_ONNX_FILE")
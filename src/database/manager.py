@@ -1,38 +1,153 @@
-"""Context manager for PostgreSQL database connection."""
+"""Context manager for pooled PostgreSQL database connections."""
 
+from functools import lru_cache
+import hashlib
+from threading import BoundedSemaphore, Lock
 from types import TracebackType
-from typing import Optional
+from typing import Any, Optional, Sequence
 
 from pgvector.psycopg2 import register_vector
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extensions import connection
+from psycopg2.pool import ThreadedConnectionPool
 
-from src.config import POSTGRES_DB_URL
+from src.config import POSTGRES_DB_URL, POSTGRES_READER_DB_URL
+
+POOL_MIN_CONNECTIONS = 4
+POOL_MAX_CONNECTIONS = 32
+# Startup options are also what RESET ALL restores when a connection is
+# returned, so these stay the session defaults across checkouts.
+SESSION_OPTIONS = "-c client_min_messages=error -c hnsw.ef_search=100"
+READONLY_OPTIONS = f"{SESSION_OPTIONS} -c default_transaction_read_only=on"
+
+_POOLS: dict[tuple[str, bool], "_BlockingPool"] = {}
+_POOLS_LOCK = Lock()
+
+
+@lru_cache(maxsize=256)
+def _statement_name(sql: str) -> str:
+    """Derive a stable prepared statement name from the statement text."""
+    return f"stmt_{hashlib.sha1(sql.encode()).hexdigest()[:16]}"
+
+
+class _Connection(connection):
+    """psycopg2 connection that tracks vector adapters and prepared statements."""
+
+    initialized: bool = False
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        """Open the connection with no statements prepared yet."""
+        super().__init__(*args, **kwargs)
+        self.prepared: set[str] = set()
+
+
+class _BlockingPool(ThreadedConnectionPool):
+    """Threaded pool whose checkouts wait for a free connection instead of failing."""
+
+    def __init__(self, minconn: int, maxconn: int, *args: Any, **kwargs: Any) -> None:
+        """Open the pool with one semaphore slot per allowed connection."""
+        self._slots = BoundedSemaphore(maxconn)
+        super().__init__(minconn, maxconn, *args, **kwargs)
+
+    def getconn(self, key: Any = None) -> connection:
+        """Block until a connection slot is free, then check one out."""
+        self._slots.acquire()
+        try:
+            return super().getconn(key)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn: Any = None, key: Any = None, close: bool = False) -> None:
+        """Return a connection to the pool and free its slot."""
+        try:
+            super().putconn(conn, key, close)
+        finally:
+            self._slots.release()
+
+
+def _get_pool(url: str, readonly: bool = False) -> _BlockingPool:
+    """Return the connection pool for a database URL and mode, creating it once."""
+    key = (url, readonly)
+    with _POOLS_LOCK:
+        pool = _POOLS.get(key)
+        if pool is None:
+            pool = _BlockingPool(
+                minconn=POOL_MIN_CONNECTIONS,
+                maxconn=POOL_MAX_CONNECTIONS,
+                dsn=url,
+                options=READONLY_OPTIONS if readonly else SESSION_OPTIONS,
+                connection_factory=_Connection,
+            )
+            _POOLS[key] = pool
+    return pool
 
 
 class Manager:
 
-    def __init__(self, url: Optional[str] = None) -> None:
-        """Configure the manager with a database URL."""
-        self.db_url = url if url else POSTGRES_DB_URL
-        self.cursor = None
+    def __init__(
+        self,
+        url: Optional[str] = None,
+        cursor_factory: Optional[type] = None,
+        vector: bool = True,
+        name: Optional[str] = None,
+        readonly: bool = False,
+    ) -> None:
+        """Configure the manager with a database URL and cursor type."""
+        self.readonly = readonly
+        if url:
+            self.db_url = url
+        else:
+            self.db_url = POSTGRES_READER_DB_URL if readonly else POSTGRES_DB_URL
+        self.cursor_factory = cursor_factory
+        self.name = name
+        self.vector = vector
+        self.cursor: Any = None
         self.conn = None
 
     def _connect(self) -> None:
-        """Establish the connection and ensure extensions."""
-        self.conn = psycopg2.connect(dsn=self.db_url)
-        self.cursor = self.conn.cursor(cursor_factory=RealDictCursor)
-        self.cursor.execute("CREATE EXTENSION IF NOT EXISTS vector;")
-        self.cursor.execute("SET client_min_messages TO error;")
-        self.conn.commit()
-        register_vector(self.conn)
+        """Check out a pooled connection and open a cursor."""
+        self.conn = _get_pool(self.db_url, self.readonly).getconn()
+        if self.vector and not self.conn.initialized:
+            register_vector(self.conn)
+            self.conn.initialized = True
+        self.cursor = self.conn.cursor(
+            name=self.name, cursor_factory=self.cursor_factory
+        )
 
     def _disconnect(self) -> None:
-        """Close cursor and connection if present."""
+        """Close the cursor and return the connection to the pool."""
         if self.cursor:
             self.cursor.close()
         if self.conn:
-            self.conn.close()
+            discard = bool(self.conn.closed)
+            if not discard:
+                # RESET ALL rather than conn.reset(), whose DISCARD ALL would
+                # also drop the connection's prepared statements.
+                try:
+                    self.conn.rollback()
+                    self.conn.autocommit = True
+                    with self.conn.cursor() as cursor:
+                        cursor.execute("RESET ALL")
+                    self.conn.autocommit = False
+                except psycopg2.Error:
+                    discard = True
+            _get_pool(self.db_url, self.readonly).putconn(self.conn, close=discard)
+        self.cursor = None
+        self.conn = None
+
+    def execute_prepared(self, sql: str, params: Sequence[Any] = ()) -> None:
+        """Run a %s-parameterized statement through a per-connection prepared plan."""
+        name = _statement_name(sql)
+        if name not in self.conn.prepared:
+            numbered = sql % tuple(f"${idx}" for idx in range(1, len(params) + 1))
+            self.cursor.execute(f"PREPARE {name} AS {numbered}")
+            self.conn.prepared.add(name)
+        if params:
+            placeholders = ", ".join(["%s"] * len(params))
+            self.cursor.execute(f"EXECUTE {name} ({placeholders})", params)
+        else:
+            self.cursor.execute(f"EXECUTE {name}")
 
     def __enter__(self) -> "Manager":
         """Enter the context and return the manager."""
@@ -45,5 +160,5 @@ class Manager:
         exc_val: Optional[BaseException],
         exc_tb: Optional[TracebackType],
     ) -> None:
-        """Disconnect regardless of context outcome."""
+        """Return the connection to the pool regardless of context outcome."""
         self._disconnect()
@@ -1,6 +1,8 @@
 """Database schema management and bulk upsert helpers."""
 
+from io import BytesIO
 from itertools import batched
+import struct
 from typing import Any, Sequence
 
 import numpy as np
@@ -8,12 +10,39 @@ from psycopg2.extras import execute_values
 from tqdm import tqdm
 import typer
 
+from src.config import ensure_dirs
 from src.database.manager import Manager
 
 app = typer.Typer()
 
+ATTRIBUTE_COLUMNS = (
+    "title",
+    "brand",
+    "category",
+    "price",
+    "color",
+    "url",
+    "image1",
+    "image2",
+    "text1",
+    "text2",
+    "text3",
+    "texts",
+)
+FEATURE_COLUMNS = ("clip_image1", "clip_image2", "clip_text", "st_text")
+
+_COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+_COPY_TRAILER = struct.pack("!h", -1)
+_COPY_NULL = struct.pack("!i", -1)
+_ATTRIBUTES_FIELD_COUNT = struct.pack("!h", 1 + len(ATTRIBUTE_COLUMNS))
+_FEATURES_FIELD_COUNT = struct.pack("!h", 1 + len(FEATURE_COLUMNS))
+
+HNSW_M = 24
+HNSW_EF_CONSTRUCTION = 128
+
+ddl = """
+    CREATE EXTENSION IF NOT EXISTS vector;
 
-ddl = f"""
     CREATE SCHEMA IF NOT EXISTS item;
 
     CREATE TABLE IF NOT EXISTS item.attributes (
@@ -38,10 +67,10 @@ ddl = f"""
         created         TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
         updated         TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
         sku             VARCHAR(100) PRIMARY KEY,
-        clip_image1     vector(512),
-        clip_image2     vector(512),
-        clip_text       vector(512),
-        st_text         vector(384)
+        clip_image1     halfvec(512),
+        clip_image2     halfvec(512),
+        clip_text       halfvec(512),
+        st_text         halfvec(384)
     );
 
     CREATE TABLE IF NOT EXISTS item.colors (
@@ -49,84 +78,189 @@ ddl = f"""
         target_color     VARCHAR(100)
     );
 
-    CREATE INDEX IF NOT EXISTS idx_attributes_sku ON item.attributes(sku);
-    CREATE INDEX IF NOT EXISTS idx_features_sku ON item.features(sku);
-
-    CREATE INDEX IF NOT EXISTS features_idx_clip_image1 
+    -- Back the max(updated) catalog version check with an index-only read.
+    -- Feature upserts rewrite HNSW-indexed columns and are never HOT anyway;
+    -- attribute upserts can be, so that table keeps no updated index.
+    CREATE INDEX IF NOT EXISTS features_idx_updated ON item.features (updated);
+
+    DROP INDEX IF EXISTS
+        item.idx_attributes_sku,
+        item.idx_features_sku,
+        item.attributes_idx_updated;
+
+    -- Embeddings are unit-normalized, so the cosine indexes are superseded by
+    -- inner-product ones that skip the per-comparison norms.
+    DROP INDEX IF EXISTS
+        item.features_idx_clip_image1,
+        item.features_idx_clip_image2,
+        item.features_idx_clip_text,
+        item.features_idx_st_text;
+
+    CREATE INDEX IF NOT EXISTS features_idx_clip_image1_ip
     ON item.features
-    USING ivfflat (clip_image1 vector_cosine_ops)
-    WITH (lists = 50);
+    USING hnsw (clip_image1 halfvec_ip_ops)
+    WITH (m = {m}, ef_construction = {ef_construction});
 
-    CREATE INDEX IF NOT EXISTS features_idx_clip_image2 
+    CREATE INDEX IF NOT EXISTS features_idx_clip_image2_ip
     ON item.features
-    USING ivfflat (clip_image2 vector_cosine_ops)
-    WITH (lists = 50);
+    USING hnsw (clip_image2 halfvec_ip_ops)
+    WITH (m = {m}, ef_construction = {ef_construction});
 
-    CREATE INDEX IF NOT EXISTS features_idx_clip_text
+    CREATE INDEX IF NOT EXISTS features_idx_clip_text_ip
     ON item.features
-    USING ivfflat (clip_text vector_cosine_ops)
-    WITH (lists = 50);
+    USING hnsw (clip_text halfvec_ip_ops)
+    WITH (m = {m}, ef_construction = {ef_construction});
 
-    CREATE INDEX IF NOT EXISTS features_idx_st_text
+    CREATE INDEX IF NOT EXISTS features_idx_st_text_ip
     ON item.features
-    USING ivfflat (st_text vector_cosine_ops)
-    WITH (lists = 50);
+    USING hnsw (st_text halfvec_ip_ops)
+    WITH (m = {m}, ef_construction = {ef_construction});
 """
 
 
 @app.command("init-db")
-def init_db() -> None:
+def init_db(
+    hnsw_m: int = HNSW_M,
+    hnsw_ef_construction: int = HNSW_EF_CONSTRUCTION,
+) -> None:
     """Create schemas, tables, and indexes if missing."""
-    with Manager() as db:
-        statements = [s.strip() for s in ddl.split(";") if s.strip()]
-        for s in statements:
-            db.cursor.execute(s)
+    ensure_dirs()
+    sql = ddl.format(m=hnsw_m, ef_construction=hnsw_ef_construction)
+    with Manager(vector=False) as db:
+        for s in sql.split(";"):
+            # Skip blank and comment-only chunks, which psycopg2 rejects as empty.
+            if any(
+                line.strip() and not line.strip().startswith("--")
+                for line in s.splitlines()
+            ):
+                db.cursor.execute(s.strip())
         db.conn.commit()
     typer.echo("Database initialized successfully")
 
 
+@app.command("migrate-halfvec")
+def migrate_halfvec(
+    hnsw_m: int = HNSW_M,
+    hnsw_ef_construction: int = HNSW_EF_CONSTRUCTION,
+) -> None:
+    """Convert legacy vector feature columns to halfvec and rebuild their indexes."""
+    with Manager(vector=False) as db:
+        db.cursor.execute(
+            """
+            SELECT attname, atttypmod
+            FROM pg_attribute
+            WHERE attrelid = 'item.features'::regclass
+                AND atttypid = 'vector'::regtype
+                AND NOT attisdropped
+            """
+        )
+        columns = [
+            (column, dim)
+            for column, dim in db.cursor.fetchall()
+            if column in FEATURE_COLUMNS
+        ]
+        for column, dim in columns:
+            halfvec = f"halfvec({dim})" if dim > 0 else "halfvec"
+            typer.echo(f"Converting {column} to {halfvec}")
+            db.cursor.execute(
+                f"DROP INDEX IF EXISTS item.features_idx_{column}, "
+                f"item.features_idx_{column}_ip"
+            )
+            db.cursor.execute(
+                f"""
+                ALTER TABLE item.features
+                ALTER COLUMN {column} TYPE {halfvec}
+                USING {column}::{halfvec}
+                """
+            )
+        db.conn.commit()
+
+    # Recreates the dropped HNSW indexes with halfvec_ip_ops.
+    init_db(hnsw_m=hnsw_m, hnsw_ef_construction=hnsw_ef_construction)
+
+
+@app.command("rebuild-indexes")
+def rebuild_indexes(
+    hnsw_m: int = HNSW_M,
+    hnsw_ef_construction: int = HNSW_EF_CONSTRUCTION,
+) -> None:
+    """Drop and recreate the HNSW feature indexes with new build parameters."""
+    indexes = ", ".join(f"item.features_idx_{column}_ip" for column in FEATURE_COLUMNS)
+    with Manager(vector=False) as db:
+        db.cursor.execute(f"DROP INDEX IF EXISTS {indexes}")
+        db.conn.commit()
+    init_db(hnsw_m=hnsw_m, hnsw_ef_construction=hnsw_ef_construction)
+
+
 @app.command("drop-db")
 def drop_db() -> None:
     """Drop the entire item schema."""
-    with Manager() as db:
+    with Manager(vector=False) as db:
         db.cursor.execute("DROP SCHEMA IF EXISTS item CASCADE;")
         db.conn.commit()
     typer.echo("Database dropped successfully")
 
 
+def _pack_attribute(value: Any) -> bytes:
+    """Encode an attribute value as a binary COPY text field."""
+    if value is None:
+        return _COPY_NULL
+    return _pack_text(str(value))
+
+
+def _attributes_copy_buffer(batch: Sequence[dict[str, Any]]) -> BytesIO:
+    """Serialize a batch of attribute records into a binary COPY stream."""
+    buffer = BytesIO()
+    buffer.write(_COPY_HEADER)
+    for record in batch:
+        buffer.write(_ATTRIBUTES_FIELD_COUNT)
+        buffer.write(_pack_text(record["sku"]))
+        for column in ATTRIBUTE_COLUMNS:
+            buffer.write(_pack_attribute(record.get(column)))
+    buffer.write(_COPY_TRAILER)
+    buffer.seek(0)
+    return buffer
+
+
 def upsert_to_attributes(
     records: dict[str, Any] | Sequence[dict[str, Any]],
-    batch_size: int = 32,
+    batch_size: int = 1024,
 ) -> None:
-    """Upsert attribute rows in batches."""
+    """Upsert attribute rows in batches via a binary COPY staging table."""
     if not isinstance(records, list):
         records = [records]
 
-    normalized = []
-    for record in records:
-        normalized.append(
-            {
-                "sku": record["sku"],
-                "title": record.get("title"),
-                "brand": record.get("brand"),
-                "category": record.get("category"),
-                "price": record.get("price"),
-                "color": record.get("color"),
-                "url": record.get("url"),
-                "image1": record.get("image1"),
-                "image2": record.get("image2"),
-                "text1": record.get("text1"),
-                "text2": record.get("text2"),
-                "text3": record.get("text3"),
-                "texts": record.get("texts"),
-            }
+    if not records:
+        return
+
+    # Every column is staged as text and cast during the merge, so prices
+    # arrive the same way whether the scraper saw a number or a string.
+    stage_sql = f"""
+        CREATE TEMP TABLE attributes_stage (
+            seq BIGSERIAL,
+            sku TEXT,
+            {", ".join(f"{column} TEXT" for column in ATTRIBUTE_COLUMNS)}
         )
+        ON COMMIT DROP
+    """
 
-    upsert_sql = """
+    copy_sql = f"""
+        COPY attributes_stage
+        (sku, {", ".join(ATTRIBUTE_COLUMNS)})
+        FROM STDIN WITH (FORMAT BINARY)
+    """
+
+    # DISTINCT ON keeps the last staged row per sku, as a single merge
+    # cannot update the same target row twice.
+    merge_sql = """
         INSERT INTO item.attributes
             (sku, title, brand, category, price, color,
             url, image1, image2, text1, text2, text3, texts)
-        VALUES %s
+        SELECT DISTINCT ON (sku)
+            sku, title, brand, category, price::numeric, color,
+            url, image1, image2, text1, text2, text3, texts
+        FROM attributes_stage
+        ORDER BY sku, seq DESC
         ON CONFLICT (sku) DO UPDATE SET
             updated         = CURRENT_TIMESTAMP,
             title           = COALESCE(EXCLUDED.title, item.attributes.title),
@@ -143,49 +277,92 @@ def upsert_to_attributes(
             texts           = COALESCE(EXCLUDED.texts, item.attributes.texts)
     """
 
-    with Manager() as db:
+    with Manager(vector=False) as db:
+        db.cursor.execute("SET synchronous_commit = off")
+        db.cursor.execute(stage_sql)
+
+        total_batches = (len(records) + batch_size - 1) // batch_size
+
         for batch in tqdm(
-            batched(normalized, batch_size),
+            batched(records, batch_size),
             desc="Upserting attributes",
-            total=len(normalized) // batch_size,
+            total=total_batches,
         ):
-            values = [
-                (
-                    row["sku"],
-                    row["title"],
-                    row["brand"],
-                    row["category"],
-                    row["price"],
-                    row["color"],
-                    row["url"],
-                    row["image1"],
-                    row["image2"],
-                    row["text1"],
-                    row["text2"],
-                    row["text3"],
-                    row["texts"],
-                )
-                for row in batch
-            ]
-            execute_values(db.cursor, upsert_sql, values)
-            db.conn.commit()
+            db.cursor.copy_expert(copy_sql, _attributes_copy_buffer(batch))
+        db.cursor.execute(merge_sql)
+        db.conn.commit()
+
+
+def _pack_text(value: str) -> bytes:
+    """Encode a text value as a binary COPY field."""
+    body = value.encode("utf-8")
+    return struct.pack("!i", len(body)) + body
+
+
+def _pack_vectors(values: Sequence[Any]) -> list[bytes]:
+    """Encode a column of embeddings as binary COPY halfvec fields at once."""
+    fields = [_COPY_NULL] * len(values)
+    present = [idx for idx, value in enumerate(values) if value is not None]
+    if not present:
+        return fields
+
+    matrix = np.stack([values[idx] for idx in present]).astype(">f2", copy=False)
+    dim = matrix.shape[1]
+    prefix = struct.pack("!ihh", 4 + matrix.itemsize * dim, dim, 0)
+    for idx, row in zip(present, matrix):
+        fields[idx] = prefix + row.tobytes()
+    return fields
+
+
+def _features_copy_buffer(batch: Sequence[dict[str, Any]]) -> BytesIO:
+    """Serialize a batch of feature records into a binary COPY stream."""
+    columns = [
+        _pack_vectors([record.get(column) for record in batch])
+        for column in FEATURE_COLUMNS
+    ]
+
+    buffer = BytesIO()
+    buffer.write(_COPY_HEADER)
+    for record, *fields in zip(batch, *columns):
+        buffer.write(_FEATURES_FIELD_COUNT)
+        buffer.write(_pack_text(record["sku"]))
+        buffer.write(b"".join(fields))
+    buffer.write(_COPY_TRAILER)
+    buffer.seek(0)
+    return buffer
 
 
 def upsert_to_features(
     records: dict[str, Any] | Sequence[dict[str, Any]],
     batch_size: int = 32,
 ) -> None:
-    """Upsert feature vectors in batches."""
+    """Upsert feature vectors in batches via a binary COPY staging table."""
     if not isinstance(records, list):
         records = [records]
 
     if not records:
         return
 
-    upsert_sql = """
+    stage_sql = """
+        CREATE TEMP TABLE features_stage
+        (seq BIGSERIAL, LIKE item.features INCLUDING DEFAULTS)
+        ON COMMIT DROP
+    """
+
+    copy_sql = """
+        COPY features_stage
+        (sku, clip_image1, clip_image2, clip_text, st_text)
+        FROM STDIN WITH (FORMAT BINARY)
+    """
+
+    # DISTINCT ON keeps the last staged row per sku, as a single merge
+    # cannot update the same target row twice.
+    merge_sql = """
         INSERT INTO item.features
         (sku, clip_image1, clip_image2, clip_text, st_text)
-        VALUES %s
+        SELECT DISTINCT ON (sku) sku, clip_image1, clip_image2, clip_text, st_text
+        FROM features_stage
+        ORDER BY sku, seq DESC
         ON CONFLICT (sku) DO UPDATE SET
             updated = CURRENT_TIMESTAMP,
             clip_image1 = EXCLUDED.clip_image1,
@@ -198,57 +375,18 @@ def upsert_to_features(
         db.cursor.execute("SET work_mem = '256MB'")
         db.cursor.execute("SET maintenance_work_mem = '512MB'")
         db.cursor.execute("SET synchronous_commit = off")
+        db.cursor.execute(stage_sql)
 
         total_batches = (len(records) + batch_size - 1) // batch_size
-        commit_every = 5  # Commit every 5 batches to reduce overhead
-
-        for batch_idx, batch in enumerate(
-            tqdm(
-                batched(records, batch_size),
-                desc="Upserting features",
-                total=total_batches,
-            ),
-            start=1,
+
+        for start in tqdm(
+            range(0, len(records), batch_size),
+            desc="Upserting features",
+            total=total_batches,
         ):
-            values = []
-            for record in batch:
-                clip_image1 = record.get("clip_image1")
-                clip_image2 = record.get("clip_image2")
-                clip_text = record.get("clip_text")
-                st_text = record.get("st_text")
-
-                values.append(
-                    (
-                        record["sku"],
-                        (
-                            clip_image1.tolist()
-                            if isinstance(clip_image1, np.ndarray)
-                            else clip_image1
-                        ),
-                        (
-                            clip_image2.tolist()
-                            if isinstance(clip_image2, np.ndarray)
-                            else clip_image2
-                        ),
-                        (
-                            clip_text.tolist()
-                            if isinstance(clip_text, np.ndarray)
-                            else clip_text
-                        ),
-                        (
-                            st_text.tolist()
-                            if isinstance(st_text, np.ndarray)
-                            else st_text
-                        ),
-                    )
-                )
-
-            execute_values(db.cursor, upsert_sql, values, page_size=batch_size)
-
-            if batch_idx % commit_every == 0 or batch_idx == total_batches:
-                db.conn.commit()
-
-        db.cursor.execute("SET synchronous_commit = on")
+            batch = records[start : start + batch_size]
+            db.cursor.copy_expert(copy_sql, _features_copy_buffer(batch))
+        db.cursor.execute(merge_sql)
         db.conn.commit()
 
 
@@ -274,7 +412,13 @@ def upsert_to_colors(records: dict[str, Any] | Sequence[dict[str, Any]]) -> None
     ]
 
     with Manager() as db:
-        execute_values(db.cursor, upsert_sql, values)
+        execute_values(
+            db.cursor,
+            upsert_sql,
+            values,
+            template="(%s, %s)",
+            page_size=max(len(values), 1),
+        )
         db.conn.commit()
 
 
@@ -1,18 +1,20 @@
 """Color standardization utils using CLIP embeddings."""
 
+from functools import lru_cache
+import hashlib
 from typing import Sequence
 
 import numpy as np
+from psycopg2.extras import RealDictCursor
 import typer
 
+from src.config import CACHE_DIR, CLIP_MODEL_NAME, CLIP_PRETRAINED
 from src.database.manager import Manager
 from src.database.schemas import upsert_to_colors
 from src.embedding.clip import ClipEmbedder, get_clip_embedder
 
 app = typer.Typer()
 
-clip_embedder: ClipEmbedder = get_clip_embedder()
-
 CORPUS_COLORS = [
     # Neutrals
     "white",
@@ -65,7 +67,32 @@ CORPUS_COLORS = [
 corpus_color_queries: list[str] = [
     f"A piece of clothing in {color} color." for color in CORPUS_COLORS
 ]
-corpus_features = clip_embedder.encode_texts(corpus_color_queries)
+
+
+@lru_cache(maxsize=1)
+def _clip_embedder() -> ClipEmbedder:
+    """Load the CLIP embedder on first use rather than at import."""
+    return get_clip_embedder()
+
+
+@lru_cache(maxsize=1)
+def _load_or_compute_corpus_features() -> np.ndarray:
+    """Return corpus color embeddings, memoized on disk per prompt set and model."""
+    key = repr((tuple(corpus_color_queries), CLIP_MODEL_NAME, CLIP_PRETRAINED))
+    digest = hashlib.sha1(key.encode()).hexdigest()
+    path = CACHE_DIR / f"corpus_colors_{digest}.npy"
+    if path.exists():
+        return np.ascontiguousarray(np.load(path), dtype=np.float32)
+
+    features = np.ascontiguousarray(
+        _clip_embedder().encode_texts(corpus_color_queries), dtype=np.float32
+    )
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "wb") as f:
+        np.save(f, features)
+    tmp_path.replace(path)
+    return features
 
 
 @app.command("embed")
@@ -73,7 +100,7 @@ def embed() -> None:
     """Calculate database color embeddings and store mappings."""
     typer.echo("Embedding colors")
 
-    with Manager() as db:
+    with Manager(cursor_factory=RealDictCursor) as db:
         sql = """SELECT DISTINCT color FROM item.attributes;"""
         db.cursor.execute(sql)
         records = db.cursor.fetchall()
@@ -83,13 +110,15 @@ def embed() -> None:
         f"A piece of clothing in {color} color." for color in query_colors
     ]
 
-    query_features = clip_embedder.encode_texts(query_color_queries)
+    corpus_features = _load_or_compute_corpus_features()
+    query_features = _clip_embedder().encode_texts(query_color_queries)
     similarity_matrix = np.dot(corpus_features, query_features.T)
 
-    matches: dict[str, str] = {}
-    for i, query_color in enumerate(query_colors):
-        best_idx = np.argmax(similarity_matrix[:, i])
-        matches[query_color] = CORPUS_COLORS[best_idx]
+    best_indices = similarity_matrix.argmax(axis=0)
+    matches: dict[str, str] = {
+        query_color: CORPUS_COLORS[int(best_idx)]
+        for query_color, best_idx in zip(query_colors, best_indices)
+    }
 
     payload = [
         {
@@ -106,9 +135,9 @@ def embed() -> None:
 def zero_shot_color(color: str) -> tuple[str, str]:
     """Return the corpus color that best matches the query color."""
     query = f"A piece of clothing in {color} color."
-    query_features = clip_embedder.encode_texts([query])[0]
-    similarity_matrix = np.dot(corpus_features, query_features.T)
-    best_idx = np.argmax(similarity_matrix)
+    corpus_features = _load_or_compute_corpus_features()
+    query_features = _clip_embedder().encode_texts([query])[0]
+    best_idx = int(np.argmax(corpus_features @ query_features))
     return color, CORPUS_COLORS[best_idx]
 
 
@@ -1,9 +1,13 @@
 """Embedding pipeline for catalog items."""
 
+from concurrent.futures import ThreadPoolExecutor
 from itertools import batched
+import os
 from typing import Any
 
+import numpy as np
 import typer
+from psycopg2.extras import RealDictCursor
 from tqdm import tqdm
 
 from src.config import IMAGE_DIR
@@ -18,12 +22,33 @@ clip_embedder: ClipEmbedder = get_clip_embedder()
 st_embedder: STEmbedder = get_st_embedder()
 
 
+def _scan_images() -> dict[str, set[str]]:
+    """List downloaded image files per SKU directory in one pass."""
+    present: dict[str, set[str]] = {}
+    if not IMAGE_DIR.exists():
+        return present
+    with os.scandir(IMAGE_DIR) as sku_entries:
+        for sku_entry in sku_entries:
+            if sku_entry.is_dir():
+                with os.scandir(sku_entry.path) as file_entries:
+                    present[sku_entry.name] = {entry.name for entry in file_entries}
+    return present
+
+
 @app.command("embed")
 def embed(batch_size: int = 2048) -> None:
     """Backfill missing CLIP/ST corpus embeddings for catalog items."""
     typer.echo("Embedding items")
 
-    with Manager() as db:
+    present_images = _scan_images()
+
+    # ST runs on one long-lived helper thread; CLIP stays on this thread so each
+    # compiled CLIP encoder keeps a single driver thread for its CUDA graphs.
+    with (
+        Manager(cursor_factory=RealDictCursor, name="items_to_embed") as db,
+        ThreadPoolExecutor(max_workers=1) as st_executor,
+    ):
+        db.cursor.itersize = 4096
         db.cursor.execute(
             """
                 SELECT A.sku, A.image1, A.image2, A.texts
@@ -40,62 +65,53 @@ def embed(batch_size: int = 2048) -> None:
                 ;
             """
         )
-        records: list[dict[str, Any]] = db.cursor.fetchall()
-
-    total_records = len(records)
-    total_batches = (total_records + batch_size - 1) // batch_size
 
-    for record_batch in tqdm(
-        batched(records, batch_size),
-        desc="Embedding batches",
-        total=total_batches,
-    ):
-        sku_payload: dict[str, dict[str, Any]] = {
-            record["sku"]: {"sku": record["sku"]} for record in record_batch
-        }
-
-        text_jobs: list[tuple[str, Any]] = []
-        for record in record_batch:
-            texts = record.get("texts")
-            text_jobs.append((record["sku"], texts))
-
-        text_list = [text for _, text in text_jobs if text]
-        if text_list:
-            st_vectors = st_embedder.encode_texts(text_list, 256)
-            text_idx = 0
-            for sku, text in text_jobs:
-                if text:
-                    sku_payload[sku]["st_text"] = st_vectors[text_idx]
-                    text_idx += 1
-
-            clip_text_vectors = clip_embedder.encode_texts(text_list, 256)
-            text_idx = 0
-            for sku, text in text_jobs:
-                if text:
-                    sku_payload[sku]["clip_text"] = clip_text_vectors[text_idx]
-                    text_idx += 1
-
-        image_keys: list[tuple[str, str]] = []
-        image_paths: list[str] = []
-        for record in record_batch:
-            sku = record["sku"]
-            sku_dir = IMAGE_DIR / sku
-            path1 = sku_dir / "image1.jpeg"
-            if path1.exists():
-                image_paths.append(str(path1))
-                image_keys.append((sku, "image1"))
-            path2 = sku_dir / "image2.jpeg"
-            if path2.exists():
-                image_paths.append(str(path2))
-                image_keys.append((sku, "image2"))
-
-        if image_paths:
-            image_vectors = clip_embedder.encode_images(image_paths, 128)
-            for (sku, key), vector in zip(image_keys, image_vectors):
-                sku_payload[sku][f"clip_{key}"] = vector
-
-        payload = list(sku_payload.values())
-        upsert_to_features(payload, batch_size=256)
+        for record_batch in tqdm(
+            batched(db.cursor, batch_size),
+            desc="Embedding batches",
+        ):
+            sku_payload: dict[str, dict[str, Any]] = {
+                record["sku"]: {"sku": record["sku"]} for record in record_batch
+            }
+
+            text_jobs: list[tuple[str, Any]] = [
+                (record["sku"], record["texts"])
+                for record in record_batch
+                if record.get("texts")
+            ]
+            if text_jobs:
+                text_list = np.array([text for _, text in text_jobs], dtype=object)
+                unique_texts, inverse = np.unique(text_list, return_inverse=True)
+                unique_texts = unique_texts.tolist()
+                st_future = st_executor.submit(
+                    st_embedder.encode_texts, unique_texts, 256
+                )
+                clip_text_vectors = clip_embedder.encode_texts(unique_texts, 256)[
+                    inverse
+                ]
+                st_vectors = st_future.result()[inverse]
+                for (sku, _), st_vector, clip_vector in zip(
+                    text_jobs, st_vectors, clip_text_vectors
+                ):
+                    sku_payload[sku].update(st_text=st_vector, clip_text=clip_vector)
+
+            image_keys: list[tuple[str, str]] = []
+            image_paths: list[str] = []
+            for record in record_batch:
+                sku = record["sku"]
+                files = present_images.get(sku, ())
+                for key in ("image1", "image2"):
+                    if f"{key}.jpeg" in files:
+                        image_paths.append(str(IMAGE_DIR / sku / f"{key}.jpeg"))
+                        image_keys.append((sku, key))
+
+            if image_paths:
+                image_vectors = clip_embedder.encode_images(image_paths, 128)
+                for (sku, key), vector in zip(image_keys, image_vectors):
+                    sku_payload[sku][f"clip_{key}"] = vector
+
+            payload = list(sku_payload.values())
+            upsert_to_features(payload, batch_size=256)
 
 
 if __name__ == "__main__":
@@ -4,21 +4,38 @@ from typing import Sequence
 
 import numpy as np
 from sentence_transformers import SentenceTransformer
+import torch
 
-from src.config import ST_MODEL_NAME
+from src.config import ST_BACKEND, ST_MODEL_NAME, ST_ONNX_FILE
 
 
 class STEmbedder:
     """Encapsulates a SentenceTransformer encoder."""
 
-    def __init__(self) -> None:
-        """Load the configured SentenceTransformer model."""
-        self.model = SentenceTransformer(ST_MODEL_NAME)
+    def __init__(self, device: str | None = None, backend: str = ST_BACKEND) -> None:
+        """Load the configured SentenceTransformer model on the target device."""
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = device
+        self.backend = backend
+
+        # ST_ONNX_FILE selects a pre-exported graph, e.g. an INT8 quantized
+        # "onnx/model_qint8_avx512_vnni.onnx", instead of the fp32 export.
+        model_kwargs = {"file_name": ST_ONNX_FILE} if ST_ONNX_FILE else None
+        self.model = SentenceTransformer(
+            ST_MODEL_NAME,
+            device=self.device,
+            backend=self.backend,
+            model_kwargs=model_kwargs if self.backend == "onnx" else None,
+        )
+        if self.device == "cuda" and self.backend == "torch":
+            self.model.half()
 
     def encode_texts(
         self,
         texts: str | Sequence[str],
         batch_size: int = 32,
+        show_progress_bar: bool = False,
     ) -> np.ndarray:
         """Encode text inputs into normalized embeddings."""
         if isinstance(texts, str):
@@ -27,7 +44,9 @@ class STEmbedder:
         return self.model.encode(
             texts,
             batch_size=batch_size,
-            show_progress_bar=True,
+            show_progress_bar=show_progress_bar,
+            convert_to_numpy=True,
+            convert_to_tensor=False,
             normalize_embeddings=True,
         )
 
@@ -1,21 +1,41 @@
 """Zalando product image and metadata scraper."""
 
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait
+from functools import lru_cache
 from itertools import batched
-import json
-import time
+from pathlib import Path
+import shutil
 from typing import Any, Sequence
 
-from joblib import Parallel, delayed
+import orjson
 import requests
 from requests import Session
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
 import typer
+from urllib3.util.retry import Retry
 
-from src.config import ATTRIBUTE_DIR, IMAGE_DIR
+from src.config import ATTRIBUTE_DIR, IMAGE_DIR, ensure_dirs
 from src.database.schemas import upsert_to_attributes
 
 app = typer.Typer()
 
+_IMAGE_POOL = ThreadPoolExecutor(max_workers=16)
+
+_ALT_TEXT_TABLE = str.maketrans(dict.fromkeys("/;:()", " "))
+_CATEGORY_TABLE = str.maketrans(dict.fromkeys("_-/", " "))
+
+# Item query variables shared by every SKU; nested values are never mutated.
+_ITEM_VARIABLES: dict[str, Any] = {
+    "displayContext": {"module": "PRODUCT_CARD_WITH_HOVER"},
+    "isRatingEnabled": True,
+    "isSustainabilityProductScoreEnabled": False,
+    "moduleInput": {"module": "PRODUCT_CARD_WITH_HOVER"},
+    "shouldLoadGallery": False,
+    "skipHoverData": False,
+    "version": 1,
+}
+
 
 class Config:
     url = "https://www.zalando.co.uk/api/graphql/"
@@ -53,12 +73,25 @@ class Config:
         "womens-shoes-sandals",
         "womens-sports-shoes",
     ]
+    categories_per_request = 7
 
 
+@lru_cache(maxsize=1)
 def get_session() -> Session:
-    """Return a configured requests session."""
+    """Return the shared keep-alive session used by all scrapers."""
     session = requests.session()
     session.headers.update(Config.headers)
+    adapter = HTTPAdapter(
+        pool_connections=32,
+        pool_maxsize=32,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=None,
+        ),
+    )
+    session.mount("https://", adapter)
     return session
 
 
@@ -70,61 +103,84 @@ class ListScraper:
         self.config = config
         self.session = get_session()
 
+    def _make_payload(
+        self, category: str, start_cursor: str | None
+    ) -> dict[str, Any]:
+        """Build the GraphQL listing operation for one category page."""
+        return {
+            "id": self.config.list_query_id,
+            "variables": {
+                "id": f"ern:collection:cat:categ:{category}",
+                "orderBy": "POPULARITY",
+                "filters": {
+                    "discreteFilters": [],
+                    "rangeFilters": [],
+                    "toggleFilters": [],
+                },
+                "after": start_cursor,
+                "first": 84,
+                "isPaginationRequest": (start_cursor is None),
+                "fetchExperience": True,
+                "subSli": "client",
+                "width": 2079,
+                "height": 1000,
+                "isLoggedIn": False,
+                "forcedEntities": [None],
+            },
+        }
+
     def scrape_catalog(self, category: str, max_pages: int | None = None) -> list[str]:
         """Return item IDs for the given category."""
-        category_id = f"ern:collection:cat:categ:{category}"
-        item_list = []
-        start_cursor = None
-
-        while True:
+        return self.scrape_catalogs([category], max_pages)[category]
+
+    def scrape_catalogs(
+        self,
+        categories: Sequence[str],
+        max_pages: int | None = None,
+    ) -> dict[str, list[str]]:
+        """Return item IDs per category, fetching the next page of each in one POST."""
+        item_lists: dict[str, list[str]] = {category: [] for category in categories}
+        page_limits: dict[str, int | None] = dict.fromkeys(categories, max_pages)
+        cursors: dict[str, str | None] = dict.fromkeys(categories)
+        active = list(categories)
+
+        while active:
             payload = [
-                {
-                    "id": self.config.list_query_id,
-                    "variables": {
-                        "id": category_id,
-                        "orderBy": "POPULARITY",
-                        "filters": {
-                            "discreteFilters": [],
-                            "rangeFilters": [],
-                            "toggleFilters": [],
-                        },
-                        "after": start_cursor,
-                        "first": 84,
-                        "isPaginationRequest": (start_cursor is None),
-                        "fetchExperience": True,
-                        "subSli": "client",
-                        "width": 2079,
-                        "height": 1000,
-                        "isLoggedIn": False,
-                        "forcedEntities": [None],
-                    },
-                }
+                self._make_payload(category, cursors[category]) for category in active
             ]
-
-            response = self.session.post(self.config.url, data=json.dumps(payload))
+            response = self.session.post(self.config.url, data=orjson.dumps(payload))
             response.raise_for_status()
-            data = response.json()
-
-            page_info = data[0]["data"]["collection"]["entities"]["pageInfo"]
-
-            if start_cursor is None:
-                actual_max_pages = page_info.get("numberOfPages")
-                if actual_max_pages:
-                    if max_pages is None:
-                        max_pages = actual_max_pages
-                    else:
-                        max_pages = min(max_pages, actual_max_pages)
-
-            for edge in data[0]["data"]["collection"]["entities"]["edges"]:
-                item_list.append(edge["node"]["id"])
-
-            if page_info["currentPage"] >= max_pages:
-                break
-            start_cursor = page_info.get("endCursor")
-            if not start_cursor:
-                break
-
-        return item_list
+            data = orjson.loads(response.content)
+
+            next_active = []
+            for category, result in zip(active, data):
+                entities = result["data"]["collection"]["entities"]
+                page_info = entities["pageInfo"]
+
+                if cursors[category] is None:
+                    actual_max_pages = page_info.get("numberOfPages")
+                    if actual_max_pages:
+                        limit = page_limits[category]
+                        page_limits[category] = (
+                            actual_max_pages
+                            if limit is None
+                            else min(limit, actual_max_pages)
+                        )
+
+                for edge in entities["edges"]:
+                    item_lists[category].append(edge["node"]["id"])
+
+                limit = page_limits[category]
+                end_cursor = page_info.get("endCursor")
+                if (limit is not None and page_info["currentPage"] >= limit) or (
+                    not end_cursor
+                ):
+                    continue
+                cursors[category] = end_cursor
+                next_active.append(category)
+            active = next_active
+
+        return item_lists
 
 
 class ItemScraper:
@@ -139,33 +195,22 @@ class ItemScraper:
 
     def _make_payload(self, batch: Sequence[str]) -> list[dict[str, Any]]:
         """Build the GraphQL payload for a batch of SKUs."""
-        payload: list[dict[str, Any]] = []
-        for item in batch:
-            payload.append(
-                {
-                    "id": self.config.item_query_id,
-                    "variables": {
-                        "displayContext": {"module": "PRODUCT_CARD_WITH_HOVER"},
-                        "id": item,
-                        "isRatingEnabled": True,
-                        "isSustainabilityProductScoreEnabled": False,
-                        "moduleInput": {"module": "PRODUCT_CARD_WITH_HOVER"},
-                        "shouldLoadGallery": False,
-                        "skipHoverData": False,
-                        "version": 1,
-                    },
-                }
-            )
-        return payload
+        return [
+            {
+                "id": self.config.item_query_id,
+                "variables": {**_ITEM_VARIABLES, "id": item},
+            }
+            for item in batch
+        ]
 
     def _scrape_batch(self, batch: Sequence[str]) -> list[dict[str, Any]]:
         """Execute the batch request and parse results."""
         payload = self._make_payload(batch)
         response = self.session.post(
-            self.config.url, data=json.dumps(payload), timeout=10
+            self.config.url, data=orjson.dumps(payload), timeout=10
         )
         response.raise_for_status()
-        data = response.json()
+        data = orjson.loads(response.content)
 
         parsed_items: list[dict[str, Any]] = []
         for item in data:
@@ -174,32 +219,47 @@ class ItemScraper:
                 parsed_items.append(parsed_item)
         return parsed_items
 
-    def scrape_items(self, items_list: Sequence[str], batch_size: int = 16) -> None:
+    def scrape_items(
+        self,
+        items_list: Sequence[str],
+        batch_size: int = 16,
+        max_workers: int = 16,
+    ) -> None:
         """Scrape item data, persist JSON, and fetch images."""
-        for batch in tqdm(
-            batched(items_list, batch_size),
-            total=len(items_list) // batch_size,
-        ):
-            parsed_items = self._scrape_batch(tuple(batch))
-            for parsed_item in parsed_items:
-                sku = parsed_item.get("sku")
-                attribute_path = self.attribute_dir / f"{sku}.json"
-                attribute_path.parent.mkdir(parents=True, exist_ok=True)
-                attribute_path.write_text(
-                    json.dumps(parsed_item, indent=2, sort_keys=True)
+        batches = [tuple(batch) for batch in batched(items_list, batch_size)]
+        image_futures: list[Future] = []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for futures in tqdm(
+                executor.map(self._process_batch, batches),
+                total=len(batches),
+            ):
+                image_futures.extend(futures)
+        wait(image_futures)
+
+    def _process_batch(self, batch: Sequence[str]) -> list[Future]:
+        """Scrape one batch, persist its JSON, and queue its image downloads."""
+        parsed_items = self._scrape_batch(batch)
+        image_futures: list[Future] = []
+        for parsed_item in parsed_items:
+            sku = parsed_item.get("sku")
+            attribute_path = self.attribute_dir / f"{sku}.json"
+            attribute_path.parent.mkdir(parents=True, exist_ok=True)
+            attribute_path.write_bytes(
+                orjson.dumps(
+                    parsed_item,
+                    option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS,
                 )
-
-            Parallel(n_jobs=8, backend="threading")(
-                delayed(self.scrape_item_images)(parsed_item)
-                for parsed_item in parsed_items
             )
+            image_futures.extend(self.scrape_item_images(parsed_item))
+        return image_futures
 
-    def scrape_item_images(self, parsed_item: dict[str, Any]) -> None:
-        """Download packshot and model images if missing."""
+    def scrape_item_images(self, parsed_item: dict[str, Any]) -> list[Future]:
+        """Queue packshot and model image downloads if missing."""
         sku = parsed_item.get("sku")
         sku_dir = self.image_dir / sku
         sku_dir.mkdir(parents=True, exist_ok=True)
 
+        futures: list[Future] = []
         for idx, url in enumerate(
             [parsed_item.get("image1"), parsed_item.get("image2")], start=1
         ):
@@ -208,13 +268,22 @@ class ItemScraper:
             target_path = sku_dir / f"image{idx}.jpeg"
             if target_path.exists():
                 continue
-            try:
-                response = self.session.get(url, timeout=10)
+            futures.append(_IMAGE_POOL.submit(self._download_image, url, target_path))
+        return futures
+
+    def _download_image(self, url: str, target_path: Path) -> None:
+        """Stream a single image to disk, skipping it on any request failure."""
+        tmp_path = target_path.with_suffix(target_path.suffix + ".part")
+        try:
+            with self.session.get(url, timeout=10, stream=True) as response:
                 response.raise_for_status()
-                target_path.write_bytes(response.content)
-                time.sleep(0.1)
-            except Exception:
-                continue
+                response.raw.decode_content = True
+                with open(tmp_path, "wb") as f:
+                    shutil.copyfileobj(response.raw, f, length=64 * 1024)
+            tmp_path.replace(target_path)
+        except Exception:
+            tmp_path.unlink(missing_ok=True)
+            return
 
     def _build_texts(self, record: dict[str, Any]) -> str:
         """Assemble the combined text blob for embeddings."""
@@ -287,12 +356,7 @@ class ItemScraper:
 
             category = product.get("silhouette", "")
             if category:
-                category = (
-                    category.replace("_", " ")
-                    .replace("-", " ")
-                    .replace("/", " ")
-                    .lower()
-                )
+                category = category.translate(_CATEGORY_TABLE).lower()
             else:
                 category = None
 
@@ -318,34 +382,42 @@ class ItemScraper:
     def _clean_text(self, text: str | None) -> str | None:
         """Remove punctuation separators from alt text."""
         if text:
-            return (
-                text.replace("/", " ")
-                .replace(";", " ")
-                .replace(":", " ")
-                .replace("(", " ")
-                .replace(")", " ")
-            )
+            return text.translate(_ALT_TEXT_TABLE)
         return None
 
 
 @app.command("pull")
 def pull(max_pages: int | None = typer.Option(None)) -> None:
     """Scrape remote catalog data and store it locally."""
+    ensure_dirs()
     list_scraper = ListScraper()
     item_scraper = ItemScraper()
 
-    for category in Config.categories:
-        typer.echo(f"Scraping category: {category}")
-        item_list = list_scraper.scrape_catalog(category, max_pages)
-        item_scraper.scrape_items(item_list)
+    # Pagination is serial per category, so each POST carries the next page of
+    # a group of categories and the groups are listed concurrently.
+    groups = list(batched(Config.categories, Config.categories_per_request))
+    with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+        futures = [
+            executor.submit(list_scraper.scrape_catalogs, group, max_pages)
+            for group in groups
+        ]
+        for future in as_completed(futures):
+            for category, item_list in future.result().items():
+                typer.echo(f"Scraping category: {category}")
+                item_scraper.scrape_items(item_list)
+
+
+def _load_attributes(path: Path) -> dict[str, Any]:
+    """Read one scraped attribute file."""
+    return orjson.loads(path.read_bytes())
 
 
 @app.command("push")
 def push() -> None:
     """Push locally scraped attributes into the database."""
-    records: list[dict[str, Any]] = []
-    for path in ATTRIBUTE_DIR.glob("*.json"):
-        records.append(json.loads(path.read_text()))
+    paths = list(ATTRIBUTE_DIR.glob("*.json"))
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        records: list[dict[str, Any]] = list(executor.map(_load_attributes, paths))
 
     upsert_to_attributes(records)
 
@@ -0,0 +1,66 @@
+"""Dynamic batching of concurrent encoder calls."""
+
+from concurrent.futures import Future
+from queue import Empty, SimpleQueue
+from threading import Thread
+import time
+from typing import Any, Callable, Sequence
+
+import numpy as np
+
+
+class BatchScheduler:
+    """Coalesces concurrent single-input calls into one batched encoder call."""
+
+    def __init__(
+        self,
+        encode: Callable[[Sequence[Any]], np.ndarray],
+        max_batch: int = 32,
+        max_wait: float = 0.0,
+    ) -> None:
+        """Start a worker thread that drains queued inputs into batches."""
+        self.encode = encode
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue: SimpleQueue[tuple[Any, Future]] = SimpleQueue()
+        self._worker = Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(self, value: Any) -> Future:
+        """Queue one input and return a future for its embedding row."""
+        future: Future = Future()
+        self._queue.put((value, future))
+        return future
+
+    def _collect(self) -> list[tuple[Any, Future]]:
+        """Block for one input, then take whatever else arrives within max_wait."""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    batch.append(self._queue.get(timeout=timeout))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        """Encode batches forever, fanning rows back out to their futures."""
+        while True:
+            batch = self._collect()
+            try:
+                rows = self.encode([value for value, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            if len(rows) != len(batch):
+                e = RuntimeError(f"Encoder returned {len(rows)} rows for {len(batch)}")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), row in zip(batch, rows):
+                future.set_result(row)
@@ -1,9 +1,20 @@
 """Search engine wrapper combining filter extraction and query execution."""
 
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+import time
 from typing import Any, Iterable
 
 from src.search.filters import Extractor, Filters
-from src.search.query import Query, ResultItem
+from src.search.models import ResultItem
+from src.search.query import Query
+
+RRF_K = 60
+SCORE_FIELDS = {"clip_score", "st_score", "clip_score1", "clip_score2"}
+# One slot per app request thread, so a multimodal search never queues
+# behind another request's image search.
+SEARCH_WORKERS = 16
+CATALOG_CHECK_SECONDS = 30.0
 
 
 class Engine:
@@ -13,6 +24,25 @@ class Engine:
         """Initialize filter extractor and query backends."""
         self.extractor = Extractor()
         self.query = Query()
+        self._search_pool = ThreadPoolExecutor(max_workers=SEARCH_WORKERS)
+        self._catalog_version: tuple | None = None
+        self._catalog_checked = 0.0
+        self._catalog_lock = Lock()
+
+    def _check_catalog(self) -> None:
+        """Drop the search caches once the catalog has changed since the last check."""
+        now = time.monotonic()
+        if now < self._catalog_checked + CATALOG_CHECK_SECONDS:
+            return
+        with self._catalog_lock:
+            if now < self._catalog_checked + CATALOG_CHECK_SECONDS:
+                return
+            version = self.query.catalog_version()
+            if self._catalog_version is not None and version != self._catalog_version:
+                self.query.invalidate()
+                self.extractor.invalidate()
+            self._catalog_version = version
+            self._catalog_checked = now
 
     def run(
         self,
@@ -21,40 +51,62 @@ class Engine:
         k: int = 9,
     ) -> dict[str, Any]:
         """Execute a multimodal search and return formatted payload."""
+        self._check_catalog()
         filters = self.extractor(q_text) if q_text else None
-        if q_image is not None:
+        style_query = filters.style_query if filters else q_text
+        if q_image is not None and style_query:
+            image_future = self._search_pool.submit(
+                self.query.search_image, q_image, k=k, filters=filters
+            )
+            text_items = self.query.search_text(style_query, k=k, filters=filters)
+            result_items = self._fuse(image_future.result(), text_items, k)
+        elif q_image is not None:
             result_items = self.query.search_image(q_image, k=k, filters=filters)
         else:
-            result_items = self.query.search_text(
-                filters.style_query if filters else q_text,
-                k=k,
-                filters=filters,
-            )
+            result_items = self.query.search_text(style_query, k=k, filters=filters)
         return {
             "Items": self._format_items(result_items),
             "Applied Filters": self._format_filters(filters),
             "Query": self._format_query(q_text, q_image),
         }
 
+    def _fuse(
+        self,
+        image_items: list[ResultItem],
+        text_items: list[ResultItem],
+        k: int,
+    ) -> list[ResultItem]:
+        """Merge image and text rankings with reciprocal rank fusion."""
+        fused: dict[str, float] = {}
+        merged: dict[str, ResultItem] = {}
+        for items in (image_items, text_items):
+            for rank, item in enumerate(items, start=1):
+                fused[item.sku] = fused.get(item.sku, 0.0) + 1.0 / (RRF_K + rank)
+                if item.sku in merged:
+                    scores = item.model_dump(include=SCORE_FIELDS, exclude_none=True)
+                    merged[item.sku] = merged[item.sku].model_copy(update=scores)
+                else:
+                    merged[item.sku] = item
+
+        # Scale so an item ranked first by both searches scores 1.0.
+        best = 2.0 / (RRF_K + 1)
+        ranked = sorted(fused, key=fused.__getitem__, reverse=True)[:k]
+        return [
+            merged[sku].model_copy(update={"score": round(fused[sku] / best, 2)})
+            for sku in ranked
+        ]
+
     def _format_items(self, items: Iterable[ResultItem]) -> list[dict[str, Any]]:
-        """Transform raw search results into template-ready dicts."""
+        """Transform search results into template-ready dicts of SQL-rounded scores."""
         formatted_items = []
         for item in items:
             formatted_items.append(
                 {
-                    "CLIP Packshot Image Score": (
-                        f"{item.clip_score1:.2f}" if item.clip_score1 else None
-                    ),
-                    "CLIP Model Image Score": (
-                        f"{item.clip_score2:.2f}" if item.clip_score2 else None
-                    ),
-                    "CLIP Text Score": (
-                        f"{item.clip_score:.2f}" if item.clip_score else None
-                    ),
-                    "ST Text Score": (
-                        f"{item.st_score:.2f}" if item.st_score else None
-                    ),
-                    "Final Score": f"{item.score:.2f}",
+                    "CLIP Packshot Image Score": item.clip_score1,
+                    "CLIP Model Image Score": item.clip_score2,
+                    "CLIP Text Score": item.clip_score,
+                    "ST Text Score": item.st_score,
+                    "Final Score": item.score,
                     "Title": item.title,
                     "Category": item.category,
                     "Brand": item.brand,
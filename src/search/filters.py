@@ -1,13 +1,68 @@
 """OpenAI-powered filter extraction and normalization."""
 
+from collections import OrderedDict
+from threading import Lock
+import time
 from typing import Optional
 
 from openai import OpenAI
+from psycopg2.extras import RealDictCursor
 from pydantic import BaseModel, Field
+from rapidfuzz import fuzz, process, utils
 
 from src.config import OPENAI_API_KEY, OPENAI_MODEL
 from src.database.manager import Manager
 
+PROMPT_TTL_SECONDS = 300.0
+FILTERS_CACHE_SIZE = 4096
+MATCH_SCORE_CUTOFF = 85.0
+MATCHED_FIELDS = ("category", "color", "brand")
+
+EXTRACTION_PROMPT = """
+    You are a filter extraction specialist for fashion search.
+    Extract structured filters from user messages. Return category, brand and color
+    in lower case as the user wrote them; they are matched to the catalog afterwards.
+
+    **category**: the garment or shoe type mentioned, e.g. "dress", "ankle boots"
+    **brand**: the brand name mentioned, e.g. "ralph lauren"
+    **color**: the color mentioned, e.g. "reddish"
+    - Prefer dominant color: "reddish orange" -> "orange"
+    - Return None for any of these that is not mentioned
+
+    **price**: extract price ranges as numeric values, currency is always GBP
+    - "Under 50" -> max_price: 50
+    - "Over 100" -> min_price: 100
+    - "Between 50 and 100" or "50 to 100" -> min_price: 50, max_price: 100
+
+    **clean_query**: the original query without price filters and ranges
+    - "Nike shoes under 50" -> "Nike shoes"
+
+    **style_query**: remove price, category, color and brand tokens from the query
+    - "Short velvet dress by Ralph Lauren" -> "short velvet"
+    - "Pink short-sleeved blouse by DKNY over 100" -> "short-sleeved"
+    - "Emerald floral mini dress" -> "floral mini"
+    - "Denim pants with a zipper" -> "denim with a zipper"
+    - "Dress with polka dots" -> "polka dots"
+
+    **IMPORTANT**: always return the clean_query and the style_query
+"""
+
+NORMALIZATION_RULES = {
+    "category": """
+    **category**: match the garment or shoe type to the available categories
+    - Handle plurals and synonyms: "shoe" -> "shoes", "sneakers" -> "trainers"
+""",
+    "color": """
+    **color**: match the color to the available colors
+    - Handle shades and degree modifiers: "emerald" -> "green", "reddish" -> "red"
+    - Prefer dominant color: "reddish orange" -> "orange"
+""",
+    "brand": """
+    **brand**: match the brand name to the available brands
+    - Prefer shorter brand names (main brand over sub-brand)
+""",
+}
+
 
 class Filters(BaseModel):
     """Structured filters for fashion search."""
@@ -34,16 +89,61 @@ class Filters(BaseModel):
 
 class Extractor:
 
-    def __init__(self):
-        """Initialize the OpenAI client."""
+    def __init__(self, prompt_ttl: float = PROMPT_TTL_SECONDS):
+        """Initialize the OpenAI client and the filter value caches."""
         self.client = OpenAI(api_key=OPENAI_API_KEY)
+        self.prompt_ttl = prompt_ttl
+        self._values: Optional[dict[str, list[str]]] = None
+        self._values_expires = 0.0
+        self._extractions: OrderedDict[str, tuple[float, Filters]] = OrderedDict()
+        self._extractions_lock = Lock()
 
     def __call__(self, text: str) -> Filters:
-        """Extract filters from user input."""
+        """Extract filters from user input, caching them by normalized text."""
+        key = " ".join(text.lower().split())
+        now = time.monotonic()
+        with self._extractions_lock:
+            cached = self._extractions.get(key)
+            if cached is not None and now <= cached[0]:
+                self._extractions.move_to_end(key)
+                return cached[1].model_copy()
+
+        filters = self._extract(text)
+        with self._extractions_lock:
+            self._extractions[key] = (now + self.prompt_ttl, filters)
+            self._extractions.move_to_end(key)
+            while len(self._extractions) > FILTERS_CACHE_SIZE:
+                self._extractions.popitem(last=False)
+        return filters.model_copy()
+
+    def invalidate(self) -> None:
+        """Drop cached filter values and extractions so the next call reloads them."""
+        self._values = None
+        self._values_expires = 0.0
+        with self._extractions_lock:
+            self._extractions.clear()
+
+    def _extract(self, text: str) -> Filters:
+        """Extract raw filters, matching them locally before falling back to the LLM."""
+        values = self._cached_values()
+        filters = self._parse(EXTRACTION_PROMPT, text)
+        filters, unmatched = self._match_values(filters, values)
+        if not unmatched:
+            return filters
+        normalized = self._parse(self._get_system_prompt(values, unmatched), text)
+        updates: dict[str, Optional[str]] = {}
+        for field in unmatched:
+            value = getattr(normalized, field)
+            catalog = {v.lower(): v for v in values[field]}
+            updates[field] = catalog.get(value.lower()) if value else None
+        return filters.model_copy(update=updates)
+
+    def _parse(self, prompt: str, text: str) -> Filters:
+        """Run a structured OpenAI extraction with the given system prompt."""
         return self.client.responses.parse(
             model=OPENAI_MODEL,
             input=[
-                {"role": "system", "content": self._get_system_prompt()},
+                {"role": "system", "content": prompt},
                 {"role": "user", "content": text},
             ],
             text_format=Filters,
@@ -51,77 +151,65 @@ class Extractor:
             top_p=0,
         ).output_parsed
 
-    def _get_system_prompt(self):
-        """Parse the system prompt for filter extraction."""
-
-        with Manager() as db:
-            db.cursor.execute("SELECT DISTINCT category FROM item.attributes")
+    def _match_values(
+        self, filters: Filters, values: dict[str, list[str]]
+    ) -> tuple[Filters, list[str]]:
+        """Snap extracted mentions to catalog values, listing fields with no match."""
+        updates: dict[str, Optional[str]] = {}
+        unmatched: list[str] = []
+        for field in MATCHED_FIELDS:
+            mention = getattr(filters, field)
+            if mention is None:
+                continue
+            match = process.extractOne(
+                mention,
+                values[field],
+                scorer=fuzz.WRatio,
+                processor=utils.default_process,
+                score_cutoff=MATCH_SCORE_CUTOFF,
+            )
+            if match is None:
+                unmatched.append(field)
+                updates[field] = None
+            else:
+                updates[field] = match[0]
+        return filters.model_copy(update=updates), unmatched
+
+    def _cached_values(self) -> dict[str, list[str]]:
+        """Return the catalog filter values, reloading them once the TTL has elapsed."""
+        now = time.monotonic()
+        if self._values is None or now > self._values_expires:
+            self._values = self._get_filter_values()
+            self._values_expires = now + self.prompt_ttl
+        return self._values
+
+    def _get_filter_values(self) -> dict[str, list[str]]:
+        """Load the distinct categories, colors, and brands from the database."""
+        with Manager(cursor_factory=RealDictCursor, readonly=True) as db:
+            db.cursor.execute("SELECT DISTINCT category AS value FROM item.attributes")
             categories = db.cursor.fetchall()
-            db.cursor.execute("SELECT DISTINCT target_color FROM item.colors")
+            db.cursor.execute("SELECT DISTINCT target_color AS value FROM item.colors")
             colors = db.cursor.fetchall()
-            db.cursor.execute("SELECT DISTINCT brand FROM item.attributes")
+            db.cursor.execute("SELECT DISTINCT brand AS value FROM item.attributes")
             brands = db.cursor.fetchall()
 
+        return {
+            field: [row["value"] for row in rows if row["value"]]
+            for field, rows in zip(MATCHED_FIELDS, (categories, colors, brands))
+        }
+
+    def _get_system_prompt(
+        self, values: dict[str, list[str]], fields: list[str]
+    ) -> str:
+        """Build a normalization prompt listing only the given fields' values."""
+        sections = "".join(
+            f"{NORMALIZATION_RULES[field]}    Available values: {values[field]}\n"
+            for field in fields
+        )
+        names = ", ".join(fields)
         return f"""
-            You are a filter extraction and normalization specialist for fashion search.
-            Extract structured filters from user messages and MATCH them to available database values.
-
-            Available filter values in database:
-            **Available categories:**
-            {categories}
-            **Available colors:**
-            {colors}
-            **Available brands:**
-            {brands}
-
-            Filter types to extract and normalize (all values are case insensitive):
-            **category**: extract category name and match to available categories list above
-            - Handle plurals: "shoe" -> "shoes"
-            - Must match exactly to a value in the available categories list
-            - If no good match found, return None
-
-            **brand**: extract brand name and match to available brands list above
-            Match priority (in order):
-                - Exact match: "nike" -> "Nike" or "nike"
-            - Always put extractions to lower case before matching
-            - Prefer shorter brand names (main brand over sub-brand)
-            - Must match to a value in the available brands list
-            - If no good match found, return None
-
-            **color**: extract color name and match to available colors list above
-            - Handle degree modifiers: "reddish" -> "red"
-            - Prefer dominant color: "reddish orange" -> "orange"
-            - Must match exactly to a value in the available colors list
-            - If no good match found, return None
-
-            **price**: extract price ranges, no normalization needed, return numeric values
-            - Currency is always GPB. "Pounds" can be ignored.
-            - "Under 50" -> max_price: 50
-            - "Over 100" -> min_price: 100
-            - "Between 50 and 100" -> min_price: 50, max_price: 100
-            - "50 to 100" -> min_price: 50, max_price: 100
-
-            **clean_query**: original query without price filters and ranges.
-            - Remove price filter requirements from the query
-                - "Velvet pants by Ralph Lauren over 100" -> "Velvet pants by Ralph Lauren"
-                - "Nike shoes under 50" -> "Nike shoes"
-            - If no price filter requirements are present, return the original query
-
-            **style_query**: remove price, category, and brand tokens from the query
-            - Examples:
-                - "Funky pants" -> "funky"
-                - "Leather striped jacket" -> "leather striped"
-                - "Short velvet dress by Ralph Lauren" -> "short velvet"
-                - "Pink short-sleeved blouse by DKNY over 100" -> "short-sleeved"
-                - "Off-shoulder blouse" -> "off-shoulder"
-                - "Emerald floral mini dress" -> "floral mini"
-                - "Denim pants with a zipper" -> "denim with a zipper"
-                - "Striped pants by Tommy Hilfiger" -> "striped"
-                - "Dress with polka dots" -> "polka dots"
-    
-            **GENERAL RULES**:
-            - Match extracted values to available values list (case-insensitive, handle variations)
-            - Return null if no good match found in available values
-            - **IMPORTANT**: always return the clean_query
-            - **IMPORTANT**: always return the style_query
-        """
+    You are a filter normalization specialist for fashion search.
+    Extract the {names} from the user message and MATCH each of them to exactly
+    one of its available database values (case insensitive). Return None for any
+    that has no good match, and None for every other filter.
+{sections}"""
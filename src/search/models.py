@@ -0,0 +1,26 @@
+"""Shared search result models."""
+
+from typing import Optional
+
+from pydantic import BaseModel, ConfigDict
+
+
+class ResultItem(BaseModel):
+    """Pydantic model describing a single search result."""
+
+    model_config = ConfigDict(frozen=True)
+
+    sku: str
+    title: str
+    category: str
+    color: str
+    brand: str
+    price: float
+    image: str
+    text: str
+    url: str
+    clip_score: Optional[float]
+    st_score: Optional[float]
+    clip_score1: Optional[float]
+    clip_score2: Optional[float]
+    score: float
@@ -1,33 +1,189 @@
 """Search query helpers for text and image inputs."""
 
+from collections import OrderedDict
+from functools import lru_cache
+import hashlib
+from threading import Lock
+import time
 from typing import Any, Optional, Sequence, Tuple
 
-from PIL import Image
-from pydantic import BaseModel
+import numpy as np
+from psycopg2.extras import RealDictCursor
 
 from src.database.manager import Manager
-from src.embedding.clip import ClipEmbedder, get_clip_embedder
+from src.embedding.clip import ClipEmbedder, ImageInput, get_clip_embedder
 from src.embedding.st import STEmbedder, get_st_embedder
+from src.search.batching import BatchScheduler
 from src.search.filters import Filters
+from src.search.models import ResultItem
 
+HNSW_EF_SEARCH_MAX = 1000
+TEXT_CANDIDATES = 200
+IMAGE_CANDIDATES = 200
+CANDIDATE_OVERSAMPLE = 10
+TEXT_EMBEDDING_CACHE_SIZE = 10_000
+IMAGE_EMBEDDING_CACHE_SIZE = 1024
+TEXT_BATCH_SIZE = 32
+IMAGE_BATCH_SIZE = 32
+BATCH_MAX_WAIT_SECONDS = 0.005
+RESULT_CACHE_SIZE = 4096
+RESULT_CACHE_TTL_SECONDS = 600.0
 
-class ResultItem(BaseModel):
-    """Pydantic model describing a single search result."""
+CATALOG_VERSION_SQL = """
+    SELECT
+        (SELECT max(updated) FROM item.attributes) AS attributes,
+        (SELECT max(updated) FROM item.features) AS features,
+        (
+            SELECT md5(string_agg(
+                source_color || '=' || COALESCE(target_color, ''), ','
+                ORDER BY source_color
+            ))
+            FROM item.colors
+        ) AS colors
+"""
 
-    sku: str
-    title: str
-    category: str
-    color: str
-    brand: str
-    price: float
-    image: str
-    text: str
-    url: str
-    clip_score: Optional[float]
-    st_score: Optional[float]
-    clip_score1: Optional[float]
-    clip_score2: Optional[float]
-    score: float
+FILTER_CLAUSES = {
+    "brand": "A.brand = %s",
+    "category": "A.category = %s",
+    "color": "C.target_color = %s",
+    "min_price": "A.price >= %s",
+    "max_price": "A.price <= %s",
+}
+
+
+@lru_cache(maxsize=64)
+def _candidate_filter(fields: tuple[str, ...]) -> str:
+    """Build the sku restriction for the ANN candidates from set filter fields."""
+    if not fields:
+        return ""
+    clauses = " AND ".join(FILTER_CLAUSES[field] for field in fields)
+    return f"""
+                AND F.sku IN (
+                    SELECT A.sku
+                    FROM item.attributes AS A
+                    LEFT JOIN item.colors AS C ON A.color = C.source_color
+                    WHERE {clauses}
+                )"""
+
+
+@lru_cache(maxsize=64)
+def _text_search_sql(candidate_sql: str) -> str:
+    """Build the text search statement for one filter shape."""
+    return f"""
+        WITH clip AS (
+            SELECT F.sku, F.clip_image1 <#> %s::halfvec AS distance
+            FROM item.features AS F
+            WHERE 1=1{candidate_sql}
+            ORDER BY F.clip_image1 <#> %s::halfvec
+            LIMIT %s
+        )
+        , st AS (
+            SELECT F.sku, F.st_text <#> %s::halfvec AS distance
+            FROM item.features AS F
+            WHERE 1=1{candidate_sql}
+            ORDER BY F.st_text <#> %s::halfvec
+            LIMIT %s
+        )
+        , scores AS (
+            SELECT
+                F.sku,
+                -COALESCE(
+                    CL.distance, F.clip_image1 <#> %s::halfvec
+                ) AS clip_score,
+                -COALESCE(ST.distance, F.st_text <#> %s::halfvec) AS st_score
+            FROM
+                clip AS CL
+                FULL OUTER JOIN st AS ST ON CL.sku = ST.sku
+                INNER JOIN item.features AS F
+                    ON F.sku = COALESCE(CL.sku, ST.sku)
+            WHERE 1=1
+                AND F.clip_image1 IS NOT NULL
+                AND F.st_text is NOT NULL
+        )
+        , weighted AS (
+            SELECT 
+                S.sku, S.clip_score, S.st_score,
+                (
+                    S.clip_score * %s +
+                    S.st_score * %s
+                ) AS score
+            FROM 
+                scores AS S
+        )
+        SELECT
+            W.sku,
+            round(W.clip_score::numeric, 2)::float8 AS clip_score,
+            round(W.st_score::numeric, 2)::float8 AS st_score,
+            round(W.score::numeric, 2)::float8 AS score,
+            A.title,
+            A.brand, A.category, A.color, A.price::float8 AS price,
+            A.url, COALESCE(A.image2, A.image1) as image,
+            COALESCE(A.text1, A.text2, A.text3) as text
+        FROM
+            weighted AS W
+            INNER JOIN item.attributes AS A ON W.sku = A.sku
+        ORDER BY 
+            W.score DESC
+        LIMIT %s
+    """
+
+
+@lru_cache(maxsize=64)
+def _image_search_sql(candidate_sql: str) -> str:
+    """Build the image search statement for one filter shape."""
+    return f"""
+        WITH image1 AS (
+            SELECT F.sku, F.clip_image1 <#> %s::halfvec AS distance
+            FROM item.features AS F
+            WHERE 1=1{candidate_sql}
+            ORDER BY F.clip_image1 <#> %s::halfvec
+            LIMIT %s
+        )
+        , image2 AS (
+            SELECT F.sku, F.clip_image2 <#> %s::halfvec AS distance
+            FROM item.features AS F
+            WHERE 1=1{candidate_sql}
+            ORDER BY F.clip_image2 <#> %s::halfvec
+            LIMIT %s
+        )
+        , scores AS (
+            SELECT
+                F.sku,
+                -COALESCE(
+                    I1.distance, F.clip_image1 <#> %s::halfvec
+                ) AS clip_score1,
+                -COALESCE(
+                    I2.distance, F.clip_image2 <#> %s::halfvec
+                ) AS clip_score2
+            FROM
+                image1 AS I1
+                FULL OUTER JOIN image2 AS I2 ON I1.sku = I2.sku
+                INNER JOIN item.features AS F
+                    ON F.sku = COALESCE(I1.sku, I2.sku)
+        )
+        , weighted AS (
+            SELECT
+                S.sku, S.clip_score1, S.clip_score2 ,
+                GREATEST(
+                    S.clip_score1,
+                    S.clip_score2
+                ) AS score
+            FROM scores AS S
+        )
+        SELECT
+            W.sku,
+            round(W.clip_score1::numeric, 2)::float8 AS clip_score1,
+            round(W.clip_score2::numeric, 2)::float8 AS clip_score2,
+            round(W.score::numeric, 2)::float8 AS score,
+            A.title,
+            A.brand, A.category, A.color, A.price::float8 AS price,
+            A.url, COALESCE(A.image2, A.image1) as image,
+            COALESCE(A.text1, A.text2, A.text3) as text
+        FROM weighted AS W
+        INNER JOIN item.attributes AS A ON W.sku = A.sku
+        ORDER BY W.score DESC
+        LIMIT %s
+    """
 
 
 class Query:
@@ -37,31 +193,127 @@ class Query:
         """Load embedder instances for CLIP and ST."""
         self.clip_embedder: ClipEmbedder = get_clip_embedder()
         self.st_embedder: STEmbedder = get_st_embedder()
+        # One scheduler per encoder: the two models still run concurrently,
+        # and queries arriving while a model is busy share its next forward.
+        # Each scheduler is the only thread driving its compiled encoder, which
+        # CUDA graph capture and replay require.
+        self._clip_text_batcher = BatchScheduler(
+            self.clip_embedder.encode_texts,
+            max_batch=TEXT_BATCH_SIZE,
+            max_wait=BATCH_MAX_WAIT_SECONDS,
+        )
+        self._clip_image_batcher = BatchScheduler(
+            self.clip_embedder.encode_images,
+            max_batch=IMAGE_BATCH_SIZE,
+            max_wait=BATCH_MAX_WAIT_SECONDS,
+        )
+        self._st_text_batcher = BatchScheduler(
+            self.st_embedder.encode_texts,
+            max_batch=TEXT_BATCH_SIZE,
+            max_wait=BATCH_MAX_WAIT_SECONDS,
+        )
+        self.encode_text = lru_cache(maxsize=TEXT_EMBEDDING_CACHE_SIZE)(
+            self._encode_text
+        )
+        self._image_cache: OrderedDict[bytes, np.ndarray] = OrderedDict()
+        self._image_cache_lock = Lock()
+        self._result_cache: OrderedDict[tuple, tuple[float, list[ResultItem]]] = (
+            OrderedDict()
+        )
+        self._result_cache_lock = Lock()
+
+    def invalidate(self) -> None:
+        """Drop cached search results so the next searches hit the database."""
+        with self._result_cache_lock:
+            self._result_cache.clear()
+
+    def catalog_version(self) -> tuple:
+        """Return a cheap fingerprint that changes whenever the catalog is written."""
+        with Manager(readonly=True, vector=False) as db:
+            db.cursor.execute(CATALOG_VERSION_SQL)
+            return db.cursor.fetchone()
+
+    def _cached_results(self, key: tuple) -> Optional[list[ResultItem]]:
+        """Return unexpired cached results for a search key."""
+        with self._result_cache_lock:
+            entry = self._result_cache.get(key)
+            if entry is None:
+                return None
+            expires, items = entry
+            if time.monotonic() > expires:
+                del self._result_cache[key]
+                return None
+            self._result_cache.move_to_end(key)
+            return list(items)
+
+    def _store_results(self, key: tuple, items: list[ResultItem]) -> None:
+        """Cache search results for the TTL, evicting the least recently used."""
+        expires = time.monotonic() + RESULT_CACHE_TTL_SECONDS
+        with self._result_cache_lock:
+            self._result_cache[key] = (expires, list(items))
+            while len(self._result_cache) > RESULT_CACHE_SIZE:
+                self._result_cache.popitem(last=False)
+
+    def _encode_text(self, q_text: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Encode a text query with CLIP and ST concurrently."""
+        clip_future = self._clip_text_batcher.submit(q_text)
+        st_future = self._st_text_batcher.submit(q_text)
+        clip_emb, st_emb = clip_future.result(), st_future.result()
+        clip_emb.flags.writeable = False
+        st_emb.flags.writeable = False
+        return clip_emb, st_emb
+
+    def _image_key(self, image: ImageInput | Sequence[ImageInput]) -> Optional[bytes]:
+        """Hash a decoded image array by content, or None for other inputs."""
+        if not isinstance(image, np.ndarray):
+            return None
+        data = memoryview(np.ascontiguousarray(image))
+        digest = hashlib.blake2b(data, digest_size=16)
+        digest.update(repr((image.shape, image.dtype.str)).encode())
+        return digest.digest()
+
+    def encode_image(
+        self,
+        image: ImageInput | Sequence[ImageInput],
+        key: Optional[bytes] = None,
+    ) -> np.ndarray:
+        """Encode a query image with CLIP, memoizing decoded arrays by content."""
+        if isinstance(image, (list, tuple)):
+            image = image[0]
+        if key is None:
+            key = self._image_key(image)
+        if key is None:
+            return self._clip_image_batcher.submit(image).result()
+
+        with self._image_cache_lock:
+            cached = self._image_cache.get(key)
+            if cached is not None:
+                self._image_cache.move_to_end(key)
+                return cached
+
+        clip_emb = self._clip_image_batcher.submit(image).result()
+        clip_emb.flags.writeable = False
+        with self._image_cache_lock:
+            self._image_cache[key] = clip_emb
+            while len(self._image_cache) > IMAGE_EMBEDDING_CACHE_SIZE:
+                self._image_cache.popitem(last=False)
+        return clip_emb
 
     def parse_filters(self, filters: Optional[Filters]) -> Tuple[str, list[Any]]:
-        """Convert extracted filters into SQL predicate snippets."""
-        filters_sql = ""
-        params: list[Any] = []
-        if filters:
-            clauses: list[str] = []
-            if filters.brand is not None:
-                clauses.append("A.brand = %s")
-                params.append(filters.brand)
-            if filters.category is not None:
-                clauses.append("A.category = %s")
-                params.append(filters.category)
-            if filters.color is not None:
-                target_color = filters.color
-                clauses.append("C.target_color = %s")
-                params.append(target_color)
-            if filters.min_price is not None:
-                clauses.append("A.price >= %s")
-                params.append(filters.min_price)
-            if filters.max_price is not None:
-                clauses.append("A.price <= %s")
-                params.append(filters.max_price)
-            filters_sql = f" AND {' AND '.join(clauses)}" if clauses else ""
-        return filters_sql, params
+        """Convert extracted filters into a cached SQL snippet and its params."""
+        if not filters:
+            return "", []
+        values = filters.model_dump(include=FILTER_CLAUSES.keys(), exclude_none=True)
+        return _candidate_filter(tuple(values)), list(values.values())
+
+    def _configure_scan(self, db: Manager, candidates: int, filtered: bool) -> None:
+        """Set the HNSW scan options for the current transaction."""
+        # Candidates already include the per-result oversampling floor.
+        ef_search = min(candidates, HNSW_EF_SEARCH_MAX)
+        db.cursor.execute("SET LOCAL hnsw.ef_search = %s", (ef_search,))
+        if filtered:
+            # Keep walking the graph until enough rows pass the filters.
+            db.cursor.execute("SET LOCAL hnsw.iterative_scan = relaxed_order")
 
     def search_text(
         self,
@@ -72,143 +324,95 @@ class Query:
         st_weight: float = 0.50,
     ) -> list[ResultItem]:
         """Search catalog items using text embeddings."""
-        clip_emb = self.clip_embedder.encode_texts([q_text])[0]
-        clip_v = f"[{','.join(f'{v:.7f}' for v in clip_emb)}]"
-
-        st_emb = self.st_embedder.encode_texts([q_text])[0]
-        st_v = f"[{','.join(f'{v:.7f}' for v in st_emb)}]"
-
-        filters_sql, params = self.parse_filters(filters)
-
-        search_query = f"""
-            WITH scores AS (
-                SELECT
-                    F.sku,
-                    1 - (F.clip_image1 <=> '{clip_v}'::vector) as clip_score,
-                    1 - (F.st_text <=> '{st_v}'::vector) as st_score
-                FROM 
-                    item.features as F
-                WHERE 1=1
-                    AND F.clip_image1 IS NOT NULL
-                    AND F.st_text is NOT NULL
-            )
-            , weighted AS (
-                SELECT 
-                    S.sku, S.clip_score, S.st_score,
-                    (
-                        S.clip_score * {clip_weight} + 
-                        S.st_score * {st_weight}
-                    ) AS score
-                FROM 
-                    scores AS S
-            )
-            SELECT
-                W.sku, W.clip_score, W.st_score, W.score, A.title,
-                A.brand, A.category, A.color, A.price,
-                A.url, COALESCE(A.image2, A.image1) as image,
-                COALESCE(A.text1, A.text2, A.text3) as text
-            FROM
-                weighted AS W
-                INNER JOIN item.attributes AS A ON W.sku = A.sku
-                LEFT JOIN item.colors AS C ON A.color = C.source_color
-            WHERE 1=1
-                {filters_sql}
-            ORDER BY 
-                W.score DESC
-            LIMIT {k}
-        """
-
-        with Manager() as db:
-            db.cursor.execute(search_query, params)
-            results = db.cursor.fetchall()
+        candidate_sql, filter_params = self.parse_filters(filters)
+        cache_key = (
+            "text",
+            q_text,
+            k,
+            candidate_sql,
+            tuple(filter_params),
+            clip_weight,
+            st_weight,
+        )
+        cached = self._cached_results(cache_key)
+        if cached is not None:
+            return cached
 
-        result_items: list[ResultItem] = []
-        for result in results:
-            result_item = ResultItem(
-                sku=result["sku"],
-                title=result["title"],
-                category=result["category"],
-                color=result["color"],
-                brand=result["brand"],
-                price=result["price"],
-                image=result["image"],
-                text=result["text"],
-                url=result["url"],
-                clip_score=result["clip_score"],
-                st_score=result["st_score"],
-                clip_score1=None,
-                clip_score2=None,
-                score=result["score"],
-            )
-            result_items.append(result_item)
+        clip_emb, st_emb = self.encode_text(q_text)
+        candidates = max(TEXT_CANDIDATES, k * CANDIDATE_OVERSAMPLE)
+        params = [
+            clip_emb,
+            *filter_params,
+            clip_emb,
+            candidates,
+            st_emb,
+            *filter_params,
+            st_emb,
+            candidates,
+            clip_emb,
+            st_emb,
+            clip_weight,
+            st_weight,
+            k,
+        ]
 
+        search_query = _text_search_sql(candidate_sql)
+
+        with Manager(cursor_factory=RealDictCursor, readonly=True) as db:
+            self._configure_scan(db, candidates, filtered=bool(candidate_sql))
+            db.execute_prepared(search_query, params)
+            results = db.cursor.fetchall()
+
+        # Rows already carry the model's types, so skip per-field validation.
+        result_items = [
+            ResultItem.model_construct(**result, clip_score1=None, clip_score2=None)
+            for result in results
+        ]
+        self._store_results(cache_key, result_items)
         return result_items
 
     def search_image(
         self,
-        image: Image.Image | Sequence[Image.Image | str],
+        image: ImageInput | Sequence[ImageInput],
         k: int = 3,
         filters: Optional[Filters] = None,
     ) -> list[ResultItem]:
         """Search catalog items using image embeddings."""
-        clip_emb = self.clip_embedder.encode_images(image)[0]
-        clip_v = f"[{','.join(f'{v:.7f}' for v in clip_emb)}]"
-
-        filters_sql, params = self.parse_filters(filters)
-
-        search_query = f"""
-            WITH scores AS (
-                SELECT
-                    F.sku,
-                    1 - (F.clip_image1 <=> '{clip_v}'::vector) as clip_score1,
-                    1 - (F.clip_image2 <=> '{clip_v}'::vector) as clip_score2
-                FROM item.features AS F
-            )
-            , weighted AS (
-                SELECT
-                    S.sku, S.clip_score1, S.clip_score2 ,
-                    GREATEST(
-                        S.clip_score1,
-                        S.clip_score2
-                    ) AS score
-                FROM scores AS S
-            )
-            SELECT
-                W.sku, W.clip_score1, W.clip_score2, W.score, A.title,
-                A.brand, A.category, A.color, A.price,
-                A.url, COALESCE(A.image2, A.image1) as image,
-                COALESCE(A.text1, A.text2, A.text3) as text
-            FROM weighted AS W
-            INNER JOIN item.attributes AS A ON W.sku = A.sku
-            LEFT JOIN item.colors AS C ON A.color = C.source_color
-            WHERE 1=1
-                {filters_sql}
-            ORDER BY W.score DESC
-            LIMIT {k}
-        """
+        candidate_sql, filter_params = self.parse_filters(filters)
+        image_key = self._image_key(image)
+        cache_key = ("image", image_key, k, candidate_sql, tuple(filter_params))
+        if image_key is not None:
+            cached = self._cached_results(cache_key)
+            if cached is not None:
+                return cached
 
-        with Manager() as db:
-            db.cursor.execute(search_query, params)
-            results = db.cursor.fetchall()
+        clip_emb = self.encode_image(image, key=image_key)
+        candidates = max(IMAGE_CANDIDATES, k * CANDIDATE_OVERSAMPLE)
+        params = [
+            clip_emb,
+            *filter_params,
+            clip_emb,
+            candidates,
+            clip_emb,
+            *filter_params,
+            clip_emb,
+            candidates,
+            clip_emb,
+            clip_emb,
+            k,
+        ]
 
-        result_items: list[ResultItem] = []
-        for result in results:
-            result_item = ResultItem(
-                sku=result["sku"],
-                title=result["title"],
-                category=result["category"],
-                color=result["color"],
-                brand=result["brand"],
-                price=result["price"],
-                image=result["image"],
-                text=result["text"],
-                url=result["url"],
-                clip_score=None,
-                st_score=None,
-                clip_score1=result["clip_score1"],
-                clip_score2=result["clip_score2"],
-                score=result["score"],
-            )
-            result_items.append(result_item)
+        search_query = _image_search_sql(candidate_sql)
+
+        with Manager(cursor_factory=RealDictCursor, readonly=True) as db:
+            self._configure_scan(db, candidates, filtered=bool(candidate_sql))
+            db.execute_prepared(search_query, params)
+            results = db.cursor.fetchall()
 
+        result_items = [
+            ResultItem.model_construct(**result, clip_score=None, st_score=None)
+            for result in results
+        ]
+        if image_key is not None:
+            self._store_results(cache_key, result_items)
         return result_items